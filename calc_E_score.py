@@ -19,17 +19,40 @@ Usage:
     python calc_E_score.py --input data/gwas_results/*.assoc.txt --output output/escore_results.txt
 
 Dependencies:
-    pandas, numpy, scipy
+    pandas, numpy, scipy (optional: pyarrow, for faster CSV reading/writing
+    and the --cache_dir parquet cache)
 """
 
 import argparse
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os
 import sys
+import zipfile
 import pandas as pd
 import numpy as np
-from scipy.stats import chi2
-from functools import reduce
+from scipy.special import ndtri
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+# Prefer the multi-threaded pyarrow parser/writer; fall back to pandas
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+CSV_ENGINE = 'pyarrow' if HAS_PYARROW else 'c'
+
+# Rows per batch when streaming the output file
+WRITE_BATCH_SIZE = 1_000_000
+
 # =============================================================================
 # Utility Functions
 # =============================================================================
@@ -60,45 +83,238 @@ def parse_arguments():
         default='SNP', 
         help='Column name for SNP ID in input files (default: "SNP").'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=os.cpu_count(), 
+        help='Number of processes used to load input files in parallel (default: all CPUs).'
+    )
+    parser.add_argument(
+        '--chunksize', 
+        type=int, 
+        default=None, 
+        help='Read input files in chunks of this many rows to bound peak memory '
+             '(e.g. 500000). Default: read each file at once.'
+    )
+    parser.add_argument(
+        '--cache_dir', 
+        default=None, 
+        help='Directory for caching parsed traits as parquet (requires pyarrow). '
+             'Unchanged input files are not re-parsed on later runs (default: no cache).'
+    )
+    parser.add_argument(
+        '--top_k', 
+        type=int, 
+        default=None, 
+        help='Only report the K SNPs with the highest E-score (default: report all).'
+    )
+    args = parser.parse_args()
+    if args.cache_dir and not HAS_PYARROW:
+        parser.error("--cache_dir requires pyarrow")
+    if args.top_k is not None and args.top_k < 1:
+        parser.error("--top_k must be a positive integer")
+    return args
+
+def read_header_line(filepath):
+    """Reads the first line of a (possibly gzip/bz2/xz/zip-compressed) file, chosen by extension."""
+    suffix = Path(filepath).suffix.lower()
+    if suffix == '.zip':
+        # Like pandas, read the first member of the archive
+        with zipfile.ZipFile(filepath) as zf, zf.open(zf.namelist()[0]) as member:
+            return io.TextIOWrapper(member).readline()
+
+    openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+    with openers.get(suffix, open)(filepath, 'rt') as f:
+        return f.readline()
+
+def detect_delimiter(filepath):
+    """Sniffs the field delimiter (tab, comma or whitespace) from the header line."""
+    header = read_header_line(filepath)
 
-def load_and_calculate_weight(filepath, p_col_name='P'):
+    if '\t' in header:
+        return '\t'
+    if ',' in header:
+        return ','
+    return r'\s+'
+
+def get_cache_path(cache_dir, filepath, p_col_name, snp_col_name):
+    """Builds the parquet cache path for an input file, keyed by its path, mtime, size and columns."""
+    stat = os.stat(filepath)
+    key = f"{os.path.abspath(filepath)}|{stat.st_mtime_ns}|{stat.st_size}|{p_col_name}|{snp_col_name}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"{Path(filepath).stem}_{digest}.parquet"
+
+def read_trait_cache(cache_path):
+    """Reads cached (snp_ids, nlp, mean_chi2, weight_numerator) from a parquet file."""
+    table = pq.read_table(cache_path).combine_chunks()
+    metadata = table.schema.metadata
+    snp_ids = table.column('SNP').to_numpy(zero_copy_only=False)
+    nlp = table.column('NLP').to_numpy()
+    return snp_ids, nlp, float(metadata[b'mean_chi2']), float(metadata[b'weight_score'])
+
+def write_trait_cache(cache_path, snp_ids, nlp, mean_chi2, weight_numerator):
+    """Writes a trait's SNP IDs and -log10(P) to parquet, with the weight in the schema metadata."""
+    table = pa.table({'SNP': pa.array(snp_ids, type=pa.string()), 'NLP': nlp})
+    table = table.replace_schema_metadata({
+        'mean_chi2': repr(float(mean_chi2)),
+        'weight_score': repr(float(weight_numerator)),
+    })
+    
+    # Write to a temporary file first so an interrupted run never leaves
+    # a truncated cache entry behind
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+def load_and_calculate_weight(filepath, p_col_name='P', snp_col_name='SNP', chunksize=None, cache_dir=None):
     """
     Loads a single summary stat file and calculates its weight contribution.
+    Only the SNP, P (and CHI2, if present) columns are parsed; if chunksize
+    is given, the file is read in chunks of that many rows. If cache_dir is
+    given, results are cached there and reused while the file is unchanged.
     
     Returns:
-        tuple: (trait_name, DataFrame, weight_numerator)
+        tuple: (trait_name, snp_ids, nlp, mean_chi2, weight_numerator, from_cache)
+               where snp_ids is an array of SNP IDs (in file order) and nlp
+               the matching float32 array of -log10(P) values. Nothing is
+               printed on success; the caller reports a summary.
     """
     try:
-        # Read file (assuming tab-separated, auto-detect header)
-        df = pd.read_csv(filepath, sep=None, engine='python')
+        trait_name = Path(filepath).stem  # Extract filename without extension
+
+        if cache_dir:
+            cache_path = get_cache_path(cache_dir, filepath, p_col_name, snp_col_name)
+            if cache_path.exists():
+                snp_ids, nlp, mean_chi2, weight_numerator = read_trait_cache(cache_path)
+                return trait_name, snp_ids, nlp, mean_chi2, weight_numerator, True
+
+        sep = detect_delimiter(filepath)
+
+        # Cheap header-only read to validate columns before the full parse
+        header = pd.read_csv(filepath, sep=sep, nrows=0).columns
         
         # Check required columns
-        if p_col_name not in df.columns:
-            raise ValueError(f"Column '{p_col_name}' not found in {filepath}")
-            
-        # Calculate Chi-Square statistics if not present
-        if 'CHI2' not in df.columns:
-            # Convert P to Chi2: ISF is Inverse Survival Function (Inverse CDF)
-            # chi2.isf(P, df=1) approximates the Z^2 statistic
-            df['CHI2'] = chi2.isf(df[p_col_name], 1)
+        for col in (snp_col_name, p_col_name):
+            if col not in header:
+                raise ValueError(f"Column '{col}' not found in {filepath}")
+
+        # P is kept in float64: float32 underflows below ~1e-45, which is
+        # well within the range of genome-wide significant hits
+        usecols = [snp_col_name, p_col_name]
+        dtype = {snp_col_name: 'string', p_col_name: 'float64'}
+        if 'CHI2' in header:
+            usecols.append('CHI2')
+            dtype['CHI2'] = 'float64'
+
+        # The pyarrow engine supports neither regex separators nor chunked reads
+        engine = CSV_ENGINE if (sep != r'\s+' and not chunksize) else 'c'
+        read_kwargs = dict(sep=sep, engine=engine, usecols=usecols, dtype=dtype)
+        if chunksize:
+            chunks = pd.read_csv(filepath, chunksize=chunksize, **read_kwargs)
+        else:
+            chunks = [pd.read_csv(filepath, **read_kwargs)]
+
+        # Accumulate the Chi2 sum chunk by chunk so only the current chunk
+        # is ever held at full width
+        chi2_sum = 0.0
+        chi2_count = 0
+        snp_parts = []
+        nlp_parts = []
+        for chunk in chunks:
+            p_values = chunk[p_col_name].to_numpy(dtype=np.float64)
+
+            # One float64 scratch buffer per chunk, reused by every in-place
+            # ufunc below instead of allocating a temporary per step
+            buf = np.empty(len(p_values), dtype=np.float64)
+
+            if 'CHI2' in chunk.columns:
+                chi2_sum += chunk['CHI2'].sum()
+                chi2_count += chunk['CHI2'].count()
+            else:
+                # Convert P to Chi2: for df=1, Chi2 = Z^2 with Z = Phi^-1(P/2),
+                # which equals chi2.isf(P, 1) but skips the scipy.stats
+                # distribution machinery. The lower tail (P/2 rather than
+                # 1 - P/2) stays accurate for very small P.
+                # Only the sum is needed, so the Chi2 values are not stored.
+                # Missing P-values (NaN) are skipped, like Series.mean() does.
+                np.multiply(p_values, 0.5, out=buf)
+                ndtri(buf, out=buf)
+                np.multiply(buf, buf, out=buf)
+                chi2_sum += np.nansum(buf)
+                chi2_count += np.count_nonzero(~np.isnan(p_values))
+
+            # Precompute -log10(P) once per file; clip to avoid log(0) error.
+            # log10 writes straight into the float32 result (no float64 copy).
+            np.clip(p_values, 1e-300, 1.0, out=buf)
+            nlp = np.empty(len(p_values), dtype=np.float32)
+            np.log10(buf, out=nlp)
+            np.negative(nlp, out=nlp)
+
+            nlp_parts.append(nlp)
+            # Object array: a fixed-width '<U' array would cost 4 bytes x the
+            # longest SNP ID for every row, in memory and when pickled back
+            snp_parts.append(chunk[snp_col_name].to_numpy(dtype=object))
 
         # Calculate Mean Chi-Square Inflation
-        mean_chi2 = df['CHI2'].mean()
+        mean_chi2 = chi2_sum / chi2_count
         
         # Determine Weight Numerator: max(0, mean_chi2 - 1)
         # We subtract 1 because the expected mean Chi2 under null hypothesis is 1.
         weight_numerator = max(0, mean_chi2 - 1)
+
+        # np.concatenate always copies, so only join when there are several chunks
+        if len(nlp_parts) == 1:
+            snp_ids, nlp = snp_parts[0], nlp_parts[0]
+        else:
+            snp_ids = np.concatenate(snp_parts)
+            nlp = np.concatenate(nlp_parts)
+
+        if cache_dir:
+            write_trait_cache(cache_path, snp_ids, nlp, mean_chi2, weight_numerator)
         
-        trait_name = Path(filepath).stem  # Extract filename without extension
-        print(f"  [Loaded] {trait_name}: Mean Chi2 = {mean_chi2:.4f}, Weight Score = {weight_numerator:.4f}")
-        
-        return trait_name, df, weight_numerator
+        return trait_name, snp_ids, nlp, mean_chi2, weight_numerator, False
 
     except Exception as e:
         print(f"Error processing file {filepath}: {e}", file=sys.stderr)
         sys.exit(1)
 
+def write_results(filepath, snp_ids, e_scores, snp_col_name='SNP', batch_size=WRITE_BATCH_SIZE):
+    """
+    Writes the SNP / E_score table as a tab-separated file (6 decimals).
+    With pyarrow, rows are streamed in batches of batch_size: a writer thread
+    formats and writes one batch while the next one is being prepared.
+    """
+    if not HAS_PYARROW:
+        output_df = pd.DataFrame({snp_col_name: snp_ids, 'E_score': e_scores})
+        output_df.to_csv(filepath, sep='\t', index=False, float_format='%.6f')
+        return
+
+    schema = pa.schema([(snp_col_name, pa.string()), ('E_score', pa.float64())])
+    write_options = pa_csv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none')
+
+    # pyarrow formats in C and releases the GIL while writing; it always
+    # quotes header names, so the header line is written by hand
+    with open(filepath, 'wb') as f:
+        f.write(f"{snp_col_name}\tE_score\n".encode())
+        with pa_csv.CSVWriter(f, schema, write_options=write_options) as writer, \
+                ThreadPoolExecutor(max_workers=1) as write_executor:
+            pending = None
+            for start in range(0, len(e_scores), batch_size):
+                stop = start + batch_size
+                batch = pa.record_batch([
+                    pa.array(snp_ids[start:stop], type=pa.string()),
+                    np.round(e_scores[start:stop].astype(np.float64), 6),
+                ], schema=schema)
+
+                # At most one batch is being written while the next is built
+                if pending is not None:
+                    pending.result()
+                pending = write_executor.submit(writer.write_batch, batch)
+
+            if pending is not None:
+                pending.result()
+
 # =============================================================================
 # Main Logic
 # =============================================================================
@@ -115,18 +331,30 @@ def main():
     loaded_data = []
     total_weight_denom = 0.0
     
-    for filepath in args.input:
-        trait_name, df, w_num = load_and_calculate_weight(filepath, args.p_col)
-        
-        # Filter strictly necessary columns to save memory
-        df = df[[args.snp_col, args.p_col]].copy()
-        
-        # Rename P-value column to avoid collision after merge
-        df.rename(columns={args.p_col: f"P_{trait_name}"}, inplace=True)
-        
+    # Files are independent, so parse them in parallel worker processes.
+    # Each worker returns plain numpy arrays, which are cheap to pickle.
+    loader = partial(
+        load_and_calculate_weight, 
+        p_col_name=args.p_col, 
+        snp_col_name=args.snp_col, 
+        chunksize=args.chunksize, 
+        cache_dir=args.cache_dir
+    )
+    n_workers = max(1, min(args.workers or 1, len(args.input)))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(loader, args.input))
+    
+    # Workers stay silent; report all traits in one table once loading is done
+    name_width = max(len('Trait'), *(len(result[0]) for result in results))
+    print(f"  {'Trait':<{name_width}}  {'Mean Chi2':>10}  {'Weight Score':>12}  Source")
+    for trait_name, snp_ids, nlp, mean_chi2, w_num, from_cache in results:
+        source = 'cache' if from_cache else 'parsed'
+        print(f"  {trait_name:<{name_width}}  {mean_chi2:>10.4f}  {w_num:>12.4f}  {source}")
+
         loaded_data.append({
             'name': trait_name,
-            'df': df,
+            'snps': snp_ids,
+            'nlp': nlp,
             'weight_score': w_num
         })
         total_weight_denom += w_num
@@ -137,44 +365,71 @@ def main():
 
     # 2. Vectorized E-score Calculation
     # -----------------------------------------------------------
-    print("\nMerging datasets to identify common SNPs...")
+    print("\nIntersecting SNP sets to identify common SNPs...")
     
-    # Use functools.reduce to merge all DataFrames on SNP column (Inner Join)
-    # This ensures we only calculate E-scores for SNPs present in ALL summary stats
-    merged_df = reduce(
-        lambda left, right: pd.merge(left['df'], right['df'], on=args.snp_col), 
-        loaded_data
-    )
+    # Dictionary-encode the SNP IDs of all traits into one shared code space
+    # (a single hash pass over all traits), so intersection and alignment
+    # work on int32 codes instead of strings
+    snp_codes, snp_categories = pd.factorize(np.concatenate([item['snps'] for item in loaded_data]))
+    snp_codes = snp_codes.astype(np.int32)
+    offsets = np.cumsum([0] + [len(item['snps']) for item in loaded_data])
+    for k, item in enumerate(loaded_data):
+        item['codes'] = snp_codes[offsets[k]:offsets[k + 1]]
+        del item['snps']
+
+    # Intersect the code sets of all traits with a presence bitmap over the
+    # shared code space: one scatter and one AND pass per trait, no sorting.
+    # This ensures we only calculate E-scores for SNPs present in ALL
+    # summary stats, without building a wide SNP x trait table.
+    common_mask = np.zeros(len(snp_categories), dtype=bool)
+    common_mask[loaded_data[0]['codes']] = True
+    present = np.empty_like(common_mask)
+    for item in loaded_data[1:]:
+        present[:] = False
+        present[item['codes']] = True
+        np.logical_and(common_mask, present, out=common_mask)
+    del present
+    common_codes = np.flatnonzero(common_mask).astype(np.int32)
+    del common_mask
     
-    print(f"  Common SNPs identified: {len(merged_df):,}")
+    print(f"  Common SNPs identified: {len(common_codes):,}")
     print("Computing composite E-scores (Vectorized)...")
 
-    # Initialize E-score column
-    merged_df['E_score'] = 0.0
+    # Gather every trait's -log10(P) for the common SNPs into one SNP x trait
+    # float32 matrix (column-major, so each trait is written contiguously)
+    nlp_matrix = np.empty((len(common_codes), len(loaded_data)), dtype=np.float32, order='F')
+    position = np.empty(len(snp_categories), dtype=np.int64)
+    for k, item in enumerate(loaded_data):
+        # Lookup table from SNP code to row position within this trait
+        rows = np.arange(len(item['codes']))
+        position[item['codes']] = rows
+        if (position[item['codes']] != rows).any():
+            print(f"Error: Duplicate SNP IDs found in trait {item['name']}.", file=sys.stderr)
+            sys.exit(1)
+        np.take(item['nlp'], position[common_codes], out=nlp_matrix[:, k])
+
+    # Normalized Weights: w_k / Sum(w)
+    weights = np.array(
+        [item['weight_score'] / total_weight_denom for item in loaded_data],
+        dtype=np.float32
+    )
     
-    # Vectorized accumulation: Sum( -log10(P) * Normalized_Weight )
-    for item in loaded_data:
-        trait_name = item['name']
-        w_score = item['weight_score']
-        
-        # Calculate Normalized Weight
-        normalized_w = w_score / total_weight_denom
-        
-        p_col = f"P_{trait_name}"
-        
-        # Add contribution to E-score
-        # E += -log10(P) * w
-        # Use np.maximum to avoid log(0) error, though P-values should be > 0
-        p_values = np.maximum(merged_df[p_col], 1e-300) 
-        merged_df['E_score'] += -np.log10(p_values) * normalized_w
+    # Vectorized accumulation: Sum( -log10(P) * Normalized_Weight ) as a single
+    # matrix-vector product (sgemv) instead of one pass per trait
+    e_score = nlp_matrix @ weights
 
     # 3. Save Results
     # -----------------------------------------------------------
-    # Select only SNP and E_score for output (clean format)
-    output_df = merged_df[[args.snp_col, 'E_score']].sort_values(by='E_score', ascending=False)
+    # Select only SNP and E_score for output (clean format), highest first
+    if args.top_k is not None and args.top_k < len(e_score):
+        # Partial selection in O(N), then sort only the K selected SNPs
+        order = np.argpartition(-e_score, args.top_k)[:args.top_k]
+        order = order[np.argsort(-e_score[order], kind='stable')]
+    else:
+        order = np.argsort(-e_score, kind='stable')
     
     print(f"\nSaving results to: {args.output}")
-    output_df.to_csv(args.output, sep='\t', index=False, float_format='%.6f')
+    write_results(args.output, snp_categories[common_codes[order]], e_score[order], args.snp_col)
     
     print("Done.")
 